@@ -1,10 +1,23 @@
+import asyncio
+import hashlib
+import heapq
+import itertools
+import json
+import os
+import re
+import sqlite3
 import subprocess
 import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from pathlib import Path
 from typing import Optional
 
-from fastapi import FastAPI, UploadFile, File, Form
+from fastapi import FastAPI, UploadFile, File, Form, Request
 from fastapi.responses import HTMLResponse, Response, JSONResponse, PlainTextResponse
+from starlette.concurrency import run_in_threadpool
 
 app = FastAPI()
 
@@ -21,7 +34,7 @@ AI_MD_GUIDE = """# 请你在生成最终答案时，把“整篇输出”放进
    - 标题使用 # / ## / ###（不要用“1.”当作标题）。
    - 段落之间空一行。
    - 列表用 - 或 1.，子级缩进用 4 个空格。
-   - 引用用纯文本 [1] [2]（不要 BibTeX）。
+   - 引用：如果我说明已上传参考文献库，用 Pandoc 引用语法 [@key] / [@key1; @key2]（key 与文献库一致）；否则用纯文本 [1] [2]。不要在正文里输出 BibTeX 条目。
    - 不要使用 HTML 标签（如 <br> <span>）。
 
 2. **公式编写规范 (重点)**：
@@ -273,6 +286,17 @@ HTML = r"""
             </div>
           </div>
 
+          <div class="row" style="margin-top:12px;">
+            <div>
+              <label>参考文献库 .bib / CSL-JSON（可选）</label>
+              <input id="bib" type="file" accept=".bib,.json" />
+            </div>
+            <div>
+              <label>引用样式 .csl（可选）</label>
+              <input id="csl" type="file" accept=".csl" />
+            </div>
+          </div>
+
           <div style="margin-top:12px;">
             <label>Markdown 内容</label>
             <textarea id="md"># 示例
@@ -340,6 +364,8 @@ $$
       stem: document.getElementById('stem'),
       md: document.getElementById('md'),
       ref: document.getElementById('ref'),
+      bib: document.getElementById('bib'),
+      csl: document.getElementById('csl'),
       btnDownload: document.getElementById('btnDownload'),
       btnCopy: document.getElementById('btnCopy'),
       btnExample: document.getElementById('btnExample'),
@@ -370,21 +396,52 @@ $$
       window.__toast_timer = setTimeout(()=>els.toast.classList.remove('show'), 3200);
     }
 
-    function getFormData(){
+    // 文献库 / 样式只上传一次，服务端返回按内容 hash 的 id，之后转换只带 id
+    const citeIds = {};
+
+    async function uploadOnce(kind, input){
+      const f = input.files && input.files[0];
+      if (!f) return '';
+      const sig = [f.name, f.size, f.lastModified].join('|');
+      const hit = citeIds[kind];
+      if (hit && hit.sig === sig) return hit.id;
+      const fd = new FormData();
+      fd.append(kind, f, f.name);
+      const res = await fetch('/' + kind, { method:'POST', body: fd });
+      const j = await res.json().catch(()=>({error:'上传失败'}));
+      if(!res.ok) throw new Error(j.error || '上传失败');
+      const id = j[kind + '_id'];
+      citeIds[kind] = { sig, id };
+      return id;
+    }
+
+    async function getFormData(){
       const fd = new FormData();
       fd.append('stem', (els.stem.value || 'output').trim() || 'output');
       fd.append('md', els.md.value || '');
       if (els.ref.files && els.ref.files[0]) {
         fd.append('reference', els.ref.files[0], els.ref.files[0].name);
       }
+      fd.append('bib_id', await uploadOnce('bib', els.bib));
+      fd.append('csl_id', await uploadOnce('csl', els.csl));
       return fd;
     }
 
+    async function postConvert(url){
+      let res = await fetch(url, { method:'POST', body: await getFormData() });
+      if (res.status === 404) {
+        // 服务端缓存过期（重启/淘汰）：清掉本地 id，重新上传后再试一次
+        delete citeIds.bib;
+        delete citeIds.csl;
+        res = await fetch(url, { method:'POST', body: await getFormData() });
+      }
+      return res;
+    }
+
     async function downloadDocx(){
-      const fd = getFormData();
       setBusy(true, '转换并下载中…');
       try{
-        const res = await fetch('/convert', { method:'POST', body: fd });
+        const res = await postConvert('/convert');
         if(!res.ok){
           const err = await res.json().catch(()=>({error:'转换失败'}));
           throw new Error(err.error || '转换失败');
@@ -409,10 +466,9 @@ $$
     }
 
     async function copyToClipboardForWord(){
-  const fd = getFormData();
   setBusy(true, '转换并复制中…');
   try{
-    const res = await fetch('/convert_html', { method:'POST', body: fd });
+    const res = await postConvert('/convert_html');
     if(!res.ok){
       const err = await res.json().catch(()=>({error:'转换失败'}));
       throw new Error(err.error || '转换失败');
@@ -518,6 +574,8 @@ $$
     function clearAll(){
       els.stem.value = 'output';
       els.ref.value = '';
+      els.bib.value = '';
+      els.csl.value = '';
       els.md.value = '';
       toast('已清空');
     }
@@ -547,7 +605,476 @@ def prompt_text():
     return AI_MD_GUIDE
 
 
-def run_pandoc_docx(md_path: Path, out_docx: Path, ref_docx: Optional[Path]) -> None:
+# ===== 参考文献（citeproc）缓存 =====
+# 文献库 / CSL 样式只上传一次：按内容 sha256 作为 id，文献库解析成 CSL-JSON 后落盘到缓存目录，
+# 样式原样落盘。磁盘是多个 worker 共享的“真身”，内存 LRU 只是它前面的一层读缓存。
+# /convert 时只挑出正文实际引用到的条目写一个小文件给 pandoc，
+# 这样每次请求的开销只和引用条数有关，和文献库大小无关。
+CACHE_DIR = Path(tempfile.gettempdir()) / "md2docx_cache"
+CACHE_DIR_MAX_BYTES = 500_000_000  # 缓存目录总大小上限，超出按最旧优先删除
+BIB_CACHE_MAX_BYTES = 50_000_000   # 内存 LRU 上限（按解析后 JSON 字节数计）
+
+_bib_cache: "OrderedDict[str, tuple]" = OrderedDict()  # bib_id -> (entries, 字节数)
+_bib_cache_bytes = 0
+_bib_lock = threading.Lock()
+
+CACHE_ID_RE = re.compile(r"[0-9a-f]{64}")
+# Pandoc 引用 key：@key 或 @{key}；key 内部允许 :.#$%&-+?<>~/ 等标点
+CITE_KEY_RE = re.compile(r"(?<![\w@])@(?:\{([^}]+)\}|(\w[\w:.#$%&\-+?<>~/]*))")
+CITE_KEY_PUNCT = ":.#$%&-+?<>~/"
+
+
+def parse_bibliography(data: bytes, filename: str) -> dict:
+    """把 .bib / CSL-JSON 解析成 {key: CSL-JSON 条目}。"""
+    suffix = Path(filename or "").suffix.lower()
+    if suffix == ".json":
+        items = json.loads(data.decode("utf-8"))
+    elif suffix == ".bib":
+        with tempfile.TemporaryDirectory() as td:
+            bib_path = Path(td) / "refs.bib"
+            bib_path.write_bytes(data)
+            cmd = ["pandoc", str(bib_path), "-s", "-f", "biblatex", "-t", "csljson"]
+            r = subprocess.run(cmd, capture_output=True, text=True)
+            if r.returncode != 0:
+                # 非 0 退出说明 .bib 本身解析不了，属于输入错误
+                raise ValueError(
+                    "Pandoc bibliography failed.\n"
+                    f"CMD: {' '.join(cmd)}\n"
+                    f"STDERR:\n{r.stderr}\n"
+                )
+            items = json.loads(r.stdout or "[]")
+    else:
+        raise ValueError("仅支持 .bib 或 CSL-JSON（.json）格式的文献库。")
+
+    if not isinstance(items, list):
+        raise ValueError("CSL-JSON 顶层必须是数组。")
+    entries = {}
+    for item in items:
+        if isinstance(item, dict) and item.get("id") not in (None, ""):
+            key = str(item["id"])
+            entries[key] = dict(item, id=key)
+    if not entries:
+        raise ValueError("文献库中没有可用条目。")
+    return entries
+
+
+def bib_path_for(bib_id: str) -> Path:
+    return CACHE_DIR / f"{bib_id}.json"
+
+
+def csl_path_for(csl_id: str) -> Path:
+    return CACHE_DIR / f"{csl_id}.csl"
+
+
+def write_cache_file(path: Path, data: bytes) -> None:
+    """原子写入缓存目录（临时文件名唯一，并发写同一内容也不会互相踩），然后按上限清理。"""
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=CACHE_DIR, suffix=".tmp", delete=False) as f:
+        f.write(data)
+    Path(f.name).replace(path)
+    prune_cache_dir(keep=path)
+
+
+def prune_cache_dir(keep: Optional[Path] = None) -> None:
+    files = []
+    for p in CACHE_DIR.glob("*"):
+        if p.suffix not in (".json", ".csl") or p == keep:
+            continue
+        try:
+            st = p.stat()
+        except FileNotFoundError:
+            continue
+        files.append((st.st_mtime, st.st_size, p))
+    total = sum(size for _, size, _ in files)
+    for _, size, p in sorted(files):
+        if total <= CACHE_DIR_MAX_BYTES:
+            break
+        p.unlink(missing_ok=True)
+        total -= size
+
+
+def touch_cache_file(path: Path) -> bool:
+    """刷新 mtime（让清理按“最近使用”淘汰）；文件不存在返回 False。"""
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def _remember_bibliography(bib_id: str, entries: dict, size: int) -> None:
+    global _bib_cache_bytes
+    if size > BIB_CACHE_MAX_BYTES:
+        return  # 单个就超上限的不进内存，每次从磁盘读
+    with _bib_lock:
+        old = _bib_cache.pop(bib_id, None)
+        if old is not None:
+            _bib_cache_bytes -= old[1]
+        _bib_cache[bib_id] = (entries, size)
+        _bib_cache_bytes += size
+        while _bib_cache_bytes > BIB_CACHE_MAX_BYTES:
+            _, (_, evicted) = _bib_cache.popitem(last=False)
+            _bib_cache_bytes -= evicted
+
+
+def get_bibliography(bib_id: str) -> Optional[dict]:
+    with _bib_lock:
+        hit = _bib_cache.get(bib_id)
+        if hit is not None:
+            _bib_cache.move_to_end(bib_id)
+    path = bib_path_for(bib_id)
+    if hit is not None:
+        touch_cache_file(path)
+        return hit[0]
+    # 内存没有：可能是别的 worker 上传的，或被 LRU 淘汰了，读磁盘
+    try:
+        raw = path.read_bytes()
+    except FileNotFoundError:
+        return None
+    try:
+        entries = json.loads(raw.decode("utf-8"))
+    except ValueError:
+        return None
+    touch_cache_file(path)
+    _remember_bibliography(bib_id, entries, len(raw))
+    return entries
+
+
+def put_bibliography(bib_id: str, entries: dict) -> None:
+    raw = json.dumps(entries, ensure_ascii=False).encode("utf-8")
+    write_cache_file(bib_path_for(bib_id), raw)
+    _remember_bibliography(bib_id, entries, len(raw))
+
+
+def load_bibliography(bib_id: str, data: bytes, filename: str) -> dict:
+    entries = parse_bibliography(data, filename)
+    put_bibliography(bib_id, entries)
+    return entries
+
+
+def lookup_cite_sources(bib_id: str, csl_id: str) -> tuple:
+    """按 id 取出缓存的文献库与样式；找不到时抛 LookupError（让前端重新上传）。
+
+    样式在这里就读成 bytes：请求之后可能要排队，期间缓存文件可能被清理掉。
+    """
+    entries, csl_data = None, None
+    if bib_id:
+        if CACHE_ID_RE.fullmatch(bib_id):
+            entries = get_bibliography(bib_id)
+        if entries is None:
+            raise LookupError("参考文献库未找到或已过期，请重新上传。")
+    if csl_id:
+        if CACHE_ID_RE.fullmatch(csl_id):
+            path = csl_path_for(csl_id)
+            try:
+                csl_data = path.read_bytes()
+            except FileNotFoundError:
+                pass
+            else:
+                touch_cache_file(path)
+        if csl_data is None:
+            raise LookupError("CSL 样式未找到或已过期，请重新上传。")
+    return entries, csl_data
+
+
+def cited_keys(md: str, entries: dict) -> list:
+    """按出现顺序返回正文里引用到、且文献库中存在的 key（去重）。"""
+    keys = []
+    seen = set()
+    for m in CITE_KEY_RE.finditer(md):
+        key = m.group(1) or m.group(2)
+        # 句末标点会被正则吞进去（如 "@smith2020."），逐个剥掉再匹配
+        while key not in entries and key and key[-1] in CITE_KEY_PUNCT:
+            key = key[:-1]
+        if key in entries and key not in seen:
+            seen.add(key)
+            keys.append(key)
+    return keys
+
+
+def citeproc_args(td: Path, md: str, entries: Optional[dict], csl_data: Optional[bytes]) -> list:
+    if not entries:
+        return []
+    keys = cited_keys(md, entries)
+    if not keys:
+        return []
+    refs_path = td / "refs.json"
+    refs_path.write_text(json.dumps([entries[k] for k in keys], ensure_ascii=False), encoding="utf-8")
+    args = ["--citeproc", "--bibliography", str(refs_path)]
+    if csl_data is not None:
+        csl_path = td / "style.csl"
+        csl_path.write_bytes(csl_data)
+        args += ["--csl", str(csl_path)]
+    return args
+
+
+# ===== 限流 / 公平排队 =====
+# 每个客户端（API Key 或 IP）一个令牌桶，按请求成本扣令牌：基础 1 + 每 RATE_COST_BYTES 字节 1 + 带模板额外加。
+# pandoc 并发槽位用满时，按加权公平排队（WFQ）放行，避免一个人连续提交把所有槽位占满。
+# 令牌桶默认存在进程内；设置 RATE_LIMIT_DB 后改用本机 SQLite 文件，多个 worker 共享同一份限额。
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        return default
+
+
+RATE_PER_SEC = _env_float("RATE_LIMIT_RATE", 1.0)        # 每秒补充的令牌数；<=0 关闭限流
+RATE_BURST = _env_float("RATE_LIMIT_BURST", 20.0)        # 桶容量（允许的突发）
+RATE_COST_BYTES = _env_float("RATE_COST_BYTES", 100_000)  # 每多少字节输入算 1 个令牌
+RATE_COST_REFERENCE = _env_float("RATE_COST_REFERENCE", 2.0)  # 带 reference.docx 额外成本
+RATE_LIMIT_DB = os.environ.get("RATE_LIMIT_DB", "")      # 共享后端：SQLite 文件路径
+RATE_TRUSTED_PROXIES = max(0, int(_env_float("RATE_LIMIT_TRUSTED_PROXIES", 0)))  # 前面有几层可信反向代理
+PANDOC_SLOTS = max(1, int(_env_float("PANDOC_SLOTS", 2)))  # 同时运行的 pandoc 数
+QUEUE_MAX = int(_env_float("QUEUE_MAX", 64))              # 最多排队的请求数
+QUEUE_TIMEOUT = _env_float("QUEUE_TIMEOUT", 60.0)         # 排队超时（秒）
+
+
+def _parse_api_keys(raw: str) -> dict:
+    """RATE_LIMIT_API_KEYS="keyA:3,keyB" -> {"keyA": 3.0, "keyB": 1.0}（冒号后是排队权重）。"""
+    keys = {}
+    for part in raw.split(","):
+        key, _, weight = part.strip().partition(":")
+        if key:
+            try:
+                keys[key] = max(float(weight or 1), 0.01)
+            except ValueError:
+                keys[key] = 1.0
+    return keys
+
+
+API_KEY_WEIGHTS = _parse_api_keys(os.environ.get("RATE_LIMIT_API_KEYS", ""))
+
+
+class Throttled(Exception):
+    def __init__(self, status_code: int, message: str, retry_after: float):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+    def response(self) -> JSONResponse:
+        return JSONResponse(
+            status_code=self.status_code,
+            content={"error": str(self)},
+            headers={"Retry-After": str(max(1, int(self.retry_after + 0.999)))},
+        )
+
+
+def _bucket_take(tokens: float, ts: float, cost: float, now: float, rate: float, burst: float) -> tuple:
+    """补充令牌后尝试扣 cost；返回 (新令牌数, 需要等待的秒数)，等待为 0 表示放行。"""
+    tokens = min(burst, tokens + max(0.0, now - ts) * rate)
+    if tokens >= cost:
+        return tokens - cost, 0.0
+    return tokens, (cost - tokens) / rate
+
+
+class MemoryBucketStore:
+    PRUNE_AT = 10_000
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, client: str, cost: float, rate: float, burst: float) -> float:
+        now = time.time()
+        with self._lock:
+            tokens, ts = self._buckets.get(client, (burst, now))
+            tokens, wait = _bucket_take(tokens, ts, cost, now, rate, burst)
+            self._buckets[client] = (tokens, now)
+            if len(self._buckets) > self.PRUNE_AT:
+                # 已经回满的桶和“从没来过”等价，可以丢掉
+                full_after = burst / rate
+                self._buckets = {k: v for k, v in self._buckets.items() if now - v[1] < full_after}
+        return wait
+
+    def refund(self, client: str, cost: float, rate: float, burst: float) -> None:
+        now = time.time()
+        with self._lock:
+            tokens, ts = self._buckets.get(client, (burst, now))
+            tokens = min(burst, tokens + max(0.0, now - ts) * rate + cost)
+            self._buckets[client] = (tokens, now)
+
+
+class SqliteBucketStore:
+    PRUNE_EVERY = 1000
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS buckets (client TEXT PRIMARY KEY, tokens REAL NOT NULL, ts REAL NOT NULL)"
+        )
+        self._lock = threading.Lock()
+        self._calls = 0
+
+    def take(self, client: str, cost: float, rate: float, burst: float) -> float:
+        now = time.time()
+        with self._lock:
+            # BEGIN IMMEDIATE 拿写锁，保证多个 worker 的“读-改-写”不会互相覆盖
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT tokens, ts FROM buckets WHERE client = ?", (client,)).fetchone()
+                tokens, ts = row if row else (burst, now)
+                tokens, wait = _bucket_take(tokens, ts, cost, now, rate, burst)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO buckets (client, tokens, ts) VALUES (?, ?, ?)", (client, tokens, now)
+                )
+                self._calls += 1
+                if self._calls % self.PRUNE_EVERY == 0:
+                    self._conn.execute("DELETE FROM buckets WHERE ts < ?", (now - burst / rate,))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return wait
+
+    def refund(self, client: str, cost: float, rate: float, burst: float) -> None:
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE buckets SET tokens = MIN(?, tokens + MAX(0, ? - ts) * ? + ?), ts = ? WHERE client = ?",
+                (burst, now, rate, cost, now, client),
+            )
+
+
+class FairScheduler:
+    """pandoc 槽位的加权公平排队：空闲直接放行，满了按虚拟完成时间（成本 / 权重）出队。"""
+
+    def __init__(self, slots: int, max_waiting: int, timeout: float):
+        self.slots = slots
+        self.free = slots
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.vtime = 0.0
+        self.last_finish = {}
+        self.waiting = []    # 堆里只放还在等的请求
+        self.n_waiting = 0   # == len(self.waiting)；被放行或超时的立刻扣掉
+        self._seq = itertools.count()
+
+    def _tag(self, client: str, cost: float, weight: float) -> tuple:
+        start = max(self.vtime, self.last_finish.get(client, 0.0))
+        finish = start + cost / weight
+        self.last_finish[client] = finish
+        return start, finish
+
+    async def acquire(self, client: str, cost: float, weight: float) -> None:
+        if self.free > 0 and not self.n_waiting:
+            self.free -= 1
+            self.vtime = self._tag(client, cost, weight)[0]
+            return
+        if self.n_waiting >= self.max_waiting:
+            raise Throttled(503, "服务器繁忙，请稍后再试。", self.timeout / 2)
+
+        start, finish = self._tag(client, cost, weight)
+        fut = asyncio.get_running_loop().create_future()
+        entry = (finish, next(self._seq), start, fut)
+        heapq.heappush(self.waiting, entry)
+        self.n_waiting += 1
+        try:
+            await asyncio.wait_for(fut, self.timeout)
+        except BaseException as e:
+            if fut.done() and not fut.cancelled():
+                # 已经分到槽位却超时/被取消（如客户端断开）：把槽位还回去，否则槽位永久泄漏
+                self.release()
+            else:
+                # 还没轮到：从堆里摘掉，别占着 QUEUE_MAX 的名额
+                self._drop(entry)
+            if isinstance(e, asyncio.TimeoutError):
+                raise Throttled(503, "排队超时，服务器繁忙，请稍后再试。", self.timeout / 2) from None
+            raise
+
+    def _drop(self, entry: tuple) -> None:
+        for i, e in enumerate(self.waiting):
+            if e is entry:
+                self.waiting[i] = self.waiting[-1]
+                self.waiting.pop()
+                heapq.heapify(self.waiting)
+                self.n_waiting -= 1
+                return
+
+    def release(self) -> None:
+        if self.waiting:
+            # 槽位直接交给下一个等待者（free 不变）；它此刻就不再算“在等”，
+            # 否则同一轮里另一个 release 空出的槽位会被新请求误以为有人排队而不敢拿
+            _, _, start, fut = heapq.heappop(self.waiting)
+            self.n_waiting -= 1
+            self.vtime = max(self.vtime, start)
+            # 完成时间已落后于虚拟时间的客户端，和“没有历史”等价，清掉防止无限增长
+            self.last_finish = {k: v for k, v in self.last_finish.items() if v > self.vtime}
+            fut.set_result(None)
+            return
+        self.free += 1
+        if self.free == self.slots:
+            # 完全空闲时，所有客户端的历史都不再影响排序
+            self.last_finish.clear()
+
+    @asynccontextmanager
+    async def slot(self, client: str, cost: float, weight: float):
+        await self.acquire(client, cost, weight)
+        try:
+            yield
+        finally:
+            self.release()
+
+
+bucket_store = SqliteBucketStore(RATE_LIMIT_DB) if RATE_LIMIT_DB else MemoryBucketStore()
+scheduler = FairScheduler(PANDOC_SLOTS, QUEUE_MAX, QUEUE_TIMEOUT)
+
+
+def identify_client(request: Request) -> tuple:
+    """返回 (client_id, 排队权重)。只认配置过的 API Key，其余按 IP。"""
+    api_key = request.headers.get("x-api-key", "").strip()
+    if api_key in API_KEY_WEIGHTS:
+        return "key:" + hashlib.sha256(api_key.encode()).hexdigest()[:16], API_KEY_WEIGHTS[api_key]
+    host = request.client.host if request.client else "unknown"
+    if RATE_TRUSTED_PROXIES:
+        # 代理只会往右边追加，左边的内容客户端可以随便伪造：
+        # 从右往左数第 N 个才是最外层可信代理看到的真实来源
+        hops = [h.strip() for h in request.headers.get("x-forwarded-for", "").split(",") if h.strip()]
+        if len(hops) >= RATE_TRUSTED_PROXIES:
+            host = hops[-RATE_TRUSTED_PROXIES]
+    return "ip:" + host, 1.0
+
+
+def request_cost(input_bytes: int, has_reference: bool = False) -> float:
+    cost = 1.0 + input_bytes / RATE_COST_BYTES
+    if has_reference:
+        cost += RATE_COST_REFERENCE
+    # 超过桶容量的请求永远攒不够令牌，封顶到桶容量
+    return min(cost, RATE_BURST)
+
+
+async def charge_tokens(client: str, cost: float) -> None:
+    """只扣令牌、不占 pandoc 槽位（给不跑 pandoc 的轻量接口用）；不够时抛 429。"""
+    if RATE_PER_SEC <= 0:
+        return
+    wait = await run_in_threadpool(bucket_store.take, client, cost, RATE_PER_SEC, RATE_BURST)
+    if wait > 0:
+        raise Throttled(429, "请求过于频繁，请稍后再试。", wait)
+
+
+async def run_limited(request: Request, cost: float, fn, *args):
+    """先扣令牌，再排队拿 pandoc 槽位，然后在线程池里执行 fn（不阻塞事件循环）。
+
+    令牌桶可能是 SQLite（会等写锁），所以也放到线程池里；排队失败（503）时退还令牌。
+    """
+    client, weight = identify_client(request)
+    await charge_tokens(client, cost)
+    try:
+        async with scheduler.slot(client, cost, weight):
+            return await run_in_threadpool(fn, *args)
+    except Throttled:
+        if RATE_PER_SEC > 0:
+            await run_in_threadpool(bucket_store.refund, client, cost, RATE_PER_SEC, RATE_BURST)
+        raise
+
+
+def run_pandoc_docx(
+    md_path: Path,
+    out_docx: Path,
+    ref_docx: Optional[Path],
+    extra_args: Optional[list] = None,
+) -> None:
     from_format = "markdown+tex_math_dollars+tex_math_single_backslash+raw_tex"
     cmd = [
         "pandoc",
@@ -559,6 +1086,8 @@ def run_pandoc_docx(md_path: Path, out_docx: Path, ref_docx: Optional[Path]) ->
     ]
     if ref_docx is not None:
         cmd += ["--reference-doc", str(ref_docx)]
+    if extra_args:
+        cmd += extra_args
 
     r = subprocess.run(cmd, capture_output=True, text=True)
     if r.returncode != 0:
@@ -572,7 +1101,7 @@ def run_pandoc_docx(md_path: Path, out_docx: Path, ref_docx: Optional[Path]) ->
         raise RuntimeError("Pandoc returned 0 but output.docx not found.")
 
 
-def run_pandoc_html_fragment(md_path: Path) -> str:
+def run_pandoc_html_fragment(md_path: Path, extra_args: Optional[list] = None) -> str:
     from_format = "markdown+tex_math_dollars+tex_math_single_backslash+raw_tex"
     cmd = [
         "pandoc",
@@ -582,6 +1111,8 @@ def run_pandoc_html_fragment(md_path: Path) -> str:
         "--mathml",
         "--wrap=none",
     ]
+    if extra_args:
+        cmd += extra_args
     r = subprocess.run(cmd, capture_output=True, text=True)
     if r.returncode != 0:
         raise RuntimeError(
@@ -597,6 +1128,31 @@ def run_pandoc_html_fragment(md_path: Path) -> str:
 
 
 
+def build_docx(md: str, stem: str, ref_bytes: Optional[bytes], entries: Optional[dict], csl_data: Optional[bytes]) -> bytes:
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        md_path = td / f"{stem}.md"
+        out_docx = td / f"{stem}.docx"
+        md_path.write_text(md, encoding="utf-8")
+
+        ref_path = None
+        if ref_bytes is not None:
+            ref_path = td / "reference.docx"
+            ref_path.write_bytes(ref_bytes)
+
+        extra_args = citeproc_args(td, md, entries, csl_data)
+        run_pandoc_docx(md_path, out_docx, ref_path, extra_args)
+        return out_docx.read_bytes()
+
+
+def build_html_fragment(md: str, entries: Optional[dict], csl_data: Optional[bytes]) -> str:
+    with tempfile.TemporaryDirectory() as td:
+        td = Path(td)
+        md_path = td / "input.md"
+        md_path.write_text(md, encoding="utf-8")
+        return run_pandoc_html_fragment(md_path, citeproc_args(td, md, entries, csl_data))
+
+
 @app.get("/health")
 def health():
     try:
@@ -606,21 +1162,73 @@ def health():
             "pandoc_rc": r.returncode,
             "pandoc_stdout_head": (r.stdout or "")[:300],
             "pandoc_stderr_head": (r.stderr or "")[:300],
+            "pandoc_slots_free": scheduler.free,
+            "queue_waiting": scheduler.n_waiting,
         }
     except Exception as e:
         return {"ok": False, "error": str(e)}
 
 
+@app.post("/bib")
+async def upload_bib(request: Request, bib: UploadFile = File(...)):
+    data = await bib.read()
+    if len(data) > 20_000_000:
+        return JSONResponse(status_code=413, content={"error": "文献库过大（>20MB），请缩小后再试。"})
+
+    # 同一份文件只解析一次：hash 命中缓存（内存或磁盘）就直接返回。
+    # 解析方式取决于后缀，所以后缀也算进 id，同样的字节换个后缀不会拿到别的解析结果
+    suffix = Path(bib.filename or "").suffix.lower()
+    bib_id = hashlib.sha256(suffix.encode("utf-8") + b"\0" + data).hexdigest()
+    entries = await run_in_threadpool(get_bibliography, bib_id)
+    if entries is None:
+        try:
+            entries = await run_limited(request, request_cost(len(data)), load_bibliography, bib_id, data, bib.filename)
+        except Throttled as e:
+            return e.response()
+        except ValueError as e:  # 含 JSONDecodeError / UnicodeDecodeError：文件内容有问题
+            return JSONResponse(status_code=400, content={"error": str(e)})
+        except Exception as e:
+            return JSONResponse(status_code=500, content={"error": str(e)})
+    return {"bib_id": bib_id, "count": len(entries)}
+
+
+@app.post("/csl")
+async def upload_csl(request: Request, csl: UploadFile = File(...)):
+    data = await csl.read()
+    if len(data) > 1_000_000:
+        return JSONResponse(status_code=413, content={"error": "CSL 样式过大（>1MB），请缩小后再试。"})
+    if b"<style" not in data:
+        return JSONResponse(status_code=400, content={"error": "不是有效的 CSL 样式文件。"})
+
+    csl_id = hashlib.sha256(data).hexdigest()
+    path = csl_path_for(csl_id)
+    if await run_in_threadpool(touch_cache_file, path):
+        return {"csl_id": csl_id}
+    try:
+        # 只是一次小的磁盘写入：扣令牌即可，不用排队抢 pandoc 槽位
+        await charge_tokens(identify_client(request)[0], request_cost(len(data)))
+        await run_in_threadpool(write_cache_file, path, data)
+    except Throttled as e:
+        return e.response()
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"error": str(e)})
+    return {"csl_id": csl_id}
+
+
 @app.post("/convert")
 async def convert(
+    request: Request,
     md: str = Form(...),
     stem: str = Form("output"),
     reference: UploadFile | None = File(None),
+    bib_id: str = Form(""),
+    csl_id: str = Form(""),
 ):
     stem = (stem or "output").strip() or "output"
 
     # 限制：防止超大内容把免费实例拖死（可按需调整）
-    if len(md.encode("utf-8")) > 2_000_000:
+    md_size = len(md.encode("utf-8"))
+    if md_size > 2_000_000:
         return JSONResponse(status_code=413, content={"error": "Markdown 内容过大（>2MB），请缩小后再试。"})
     if reference is not None and reference.filename:
         ref_bytes = await reference.read()
@@ -630,46 +1238,47 @@ async def convert(
         ref_bytes = None
 
     try:
-        with tempfile.TemporaryDirectory() as td:
-            td = Path(td)
-            md_path = td / f"{stem}.md"
-            out_docx = td / f"{stem}.docx"
-            md_path.write_text(md, encoding="utf-8")
-
-            ref_path = None
-            if ref_bytes is not None:
-                ref_path = td / "reference.docx"
-                ref_path.write_bytes(ref_bytes)
-
-            run_pandoc_docx(md_path, out_docx, ref_path)
-            data = out_docx.read_bytes()
+        entries, csl_data = await run_in_threadpool(lookup_cite_sources, bib_id, csl_id)
+    except LookupError as e:
+        return JSONResponse(status_code=404, content={"error": str(e)})
 
+    ref_size = len(ref_bytes) if ref_bytes is not None else 0
+    cost = request_cost(md_size + ref_size, ref_bytes is not None)
+    try:
+        data = await run_limited(request, cost, build_docx, md, stem, ref_bytes, entries, csl_data)
         return Response(
             content=data,
             media_type="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
             headers={"Content-Disposition": f'attachment; filename="{stem}.docx"'},
         )
+    except Throttled as e:
+        return e.response()
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
 
 
 @app.post("/convert_html")
 async def convert_html(
+    request: Request,
     md: str = Form(...),
     stem: str = Form("output"),
     reference: UploadFile | None = File(None),
+    bib_id: str = Form(""),
+    csl_id: str = Form(""),
 ):
-    if len(md.encode("utf-8")) > 2_000_000:
+    md_size = len(md.encode("utf-8"))
+    if md_size > 2_000_000:
         return JSONResponse(status_code=413, content={"error": "Markdown 内容过大（>2MB），请缩小后再试。"})
     try:
-        with tempfile.TemporaryDirectory() as td:
-            td = Path(td)
-            md_path = td / "input.md"
-            md_path.write_text(md, encoding="utf-8")
-            frag = run_pandoc_html_fragment(md_path)
+        entries, csl_data = await run_in_threadpool(lookup_cite_sources, bib_id, csl_id)
+    except LookupError as e:
+        return JSONResponse(status_code=404, content={"error": str(e)})
+    try:
+        frag = await run_limited(request, request_cost(md_size), build_html_fragment, md, entries, csl_data)
 
         # 直接返回“片段”，前端会塞到 DOM 再复制
         return Response(content=frag, media_type="text/plain; charset=utf-8")
+    except Throttled as e:
+        return e.response()
     except Exception as e:
         return JSONResponse(status_code=500, content={"error": str(e)})
-
@@ -0,0 +1,117 @@
+import asyncio
+
+import pytest
+
+import app
+from app import FairScheduler, Throttled
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_free_slot_is_taken_immediately_after_same_tick_releases():
+    async def main():
+        s = FairScheduler(slots=2, max_waiting=10, timeout=5)
+        await s.acquire("A", 1, 1)
+        await s.acquire("B", 1, 1)
+        waiter = asyncio.create_task(s.acquire("C", 1, 1))
+        await asyncio.sleep(0)
+        assert s.n_waiting == 1
+
+        # 两个持有者在同一轮里释放：一个交给 C，另一个空出来
+        s.release()
+        s.release()
+        assert s.free == 1
+        assert s.n_waiting == 0
+
+        # 新请求应直接拿到空槽位，而不是排到下一次 release
+        await asyncio.wait_for(s.acquire("D", 1, 1), 0.1)
+        await waiter
+        assert s.free == 0
+
+    run(main())
+
+
+def test_timed_out_waiter_is_removed_from_queue():
+    async def main():
+        s = FairScheduler(slots=1, max_waiting=1, timeout=0.01)
+        await s.acquire("A", 1, 1)
+        with pytest.raises(Throttled) as exc:
+            await s.acquire("B", 1, 1)
+        assert exc.value.status_code == 503
+        assert s.waiting == []
+        assert s.n_waiting == 0
+
+        # 超时的请求不再占 QUEUE_MAX 名额
+        s.timeout = 5
+        waiter = asyncio.create_task(s.acquire("C", 1, 1))
+        await asyncio.sleep(0)
+        assert s.n_waiting == 1
+        s.release()
+        await waiter
+        s.release()
+        assert s.free == 1
+
+    run(main())
+
+
+def test_queue_full_is_rejected():
+    async def main():
+        s = FairScheduler(slots=1, max_waiting=1, timeout=5)
+        await s.acquire("A", 1, 1)
+        waiter = asyncio.create_task(s.acquire("B", 1, 1))
+        await asyncio.sleep(0)
+        with pytest.raises(Throttled) as exc:
+            await s.acquire("C", 1, 1)
+        assert exc.value.status_code == 503
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert s.n_waiting == 0
+
+    run(main())
+
+
+def test_slot_granted_then_timed_out_is_returned(monkeypatch):
+    # 模拟 3.12+ 的 wait_for：结果已经到了，超时却先触发，结果被丢弃
+    async def late_timeout(fut, timeout):
+        await fut
+        raise asyncio.TimeoutError
+
+    monkeypatch.setattr(app.asyncio, "wait_for", late_timeout)
+
+    async def main():
+        s = FairScheduler(slots=1, max_waiting=10, timeout=5)
+        await s.acquire("A", 1, 1)
+        waiter = asyncio.create_task(s.acquire("B", 1, 1))
+        await asyncio.sleep(0)
+
+        s.release()
+        with pytest.raises(Throttled):
+            await waiter
+        assert s.free == 1
+        assert s.n_waiting == 0
+
+    run(main())
+
+
+def test_waiters_interleave_across_clients():
+    async def main():
+        s = FairScheduler(slots=1, max_waiting=100, timeout=5)
+        order = []
+
+        async def job(client):
+            async with s.slot(client, 1, 1):
+                order.append(client)
+                await asyncio.sleep(0.001)
+
+        tasks = [asyncio.create_task(job("A")) for _ in range(6)]
+        await asyncio.sleep(0)
+        tasks += [asyncio.create_task(job("B")) for _ in range(3)]
+        await asyncio.gather(*tasks)
+        assert "".join(order) == "ABABABAAA"
+        assert s.free == 1
+        assert s.last_finish == {}
+
+    run(main())